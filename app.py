@@ -1,10 +1,30 @@
 import streamlit as st
-import pandas as pd
+import altair as alt
+from tsdownsample import LTTBDownsampler
 from data_fetcher import DataFetcher
 from portfolio_calculator import PortfolioCalculator
 
 st.set_page_config(page_title="活水計畫 - 智能投資組合", layout="wide")
 
+# --- Cached data access (survives reruns triggered by unrelated widgets) ---
+@st.cache_resource
+def get_fetcher():
+    return DataFetcher()
+
+@st.cache_data
+def cached_dca_projection(monthly, years, portfolio_yield_percent):
+    return PortfolioCalculator().calculate_dca_projection(monthly, years, portfolio_yield_percent)
+
+@st.cache_data
+def downsample_history(history_series, n_out=500):
+    """
+    Reduces a history series to at most n_out points (LTTB) before charting.
+    """
+    if len(history_series) <= n_out:
+        return history_series
+    idx = LTTBDownsampler().downsample(history_series.to_numpy(dtype=float), n_out=n_out)
+    return history_series.iloc[idx]
+
 # --- API Key Gatekeeper ---
 if 'gemini_api_key' not in st.session_state:
     st.session_state.gemini_api_key = ""
@@ -66,37 +86,42 @@ if total_weight != 100:
 st.sidebar.divider()
 
 # Custom Products
-st.sidebar.header("自訂商品 (選填)")
-with st.sidebar.expander("新增自訂商品"):
-    custom_symbol = st.text_input("股票代號 (例如 2330.TW)", value="")
-    custom_weight = st.number_input("配置權重 (%)", 0, 100, 0, step=5)
+def remove_custom_allocation(index):
+    # Runs as a button callback, before the (fragment) rerun that redraws the list
+    st.session_state['custom_allocations'].pop(index)
+
+# Runs as a fragment so editing the list doesn't rerun (and re-render) the results
+@st.fragment
+def custom_allocations_editor():
+    with st.expander("新增自訂商品"):
+        custom_symbol = st.text_input("股票代號 (例如 2330.TW)", value="")
+        custom_weight = st.number_input("配置權重 (%)", 0, 100, 0, step=5)
     
-    if 'custom_allocations' not in st.session_state:
-        st.session_state['custom_allocations'] = []
+        if 'custom_allocations' not in st.session_state:
+            st.session_state['custom_allocations'] = []
         
-    if st.button("加入清單"):
-        if custom_symbol and custom_weight > 0:
-            st.session_state['custom_allocations'].append({'symbol': custom_symbol, 'weight': custom_weight/100})
-            st.success(f"已加入 {custom_symbol}")
-        else:
-            st.error("請輸入代號與權重")
-            
-    # Display current custom list
-    if st.session_state['custom_allocations']:
-        st.write("已選商品:")
-        new_allocs = []
-        for i, item in enumerate(st.session_state['custom_allocations']):
-            col_c1, col_c2 = st.columns([3, 1])
-            col_c1.text(f"{item['symbol']} ({item['weight']*100:.0f}%)")
-            if col_c2.button("刪", key=f"del_{i}"):
-                pass # Will be removed in next rerun logic if we rebuild list, simpler to just clear all
+        if st.button("加入清單"):
+            if custom_symbol and custom_weight > 0:
+                st.session_state['custom_allocations'].append({'symbol': custom_symbol, 'weight': custom_weight/100})
+                st.success(f"已加入 {custom_symbol}")
             else:
-                new_allocs.append(item)
-        st.session_state['custom_allocations'] = new_allocs
+                st.error("請輸入代號與權重")
+            
+        # Display current custom list
+        if st.session_state['custom_allocations']:
+            st.write("已選商品:")
+            for i, item in enumerate(st.session_state['custom_allocations']):
+                col_c1, col_c2 = st.columns([3, 1])
+                col_c1.text(f"{item['symbol']} ({item['weight']*100:.0f}%)")
+                col_c2.button("刪", key=f"del_{i}", on_click=remove_custom_allocation, args=(i,))
         
-        if st.button("清空自訂清單"):
-            st.session_state['custom_allocations'] = []
-            st.rerun()
+            if st.button("清空自訂清單"):
+                st.session_state['custom_allocations'] = []
+                st.rerun(scope="fragment")
+
+st.sidebar.header("自訂商品 (選填)")
+with st.sidebar:
+    custom_allocations_editor()
 
 st.sidebar.divider()
 
@@ -108,12 +133,12 @@ else:
 
 if st.button("生成投資組合", type="primary", disabled=(total_weight != 100)):
     with st.spinner("正在查詢市場數據並計算多重方案..."):
-        fetcher = DataFetcher()
-        calculator = PortfolioCalculator()
         user_weights = {'Stock': w_stock/100, 'ETF': w_etf/100, 'Bond': w_bond/100}
         custom_allocs = st.session_state.get('custom_allocations', [])
         
-        scenarios = calculator.generate_scenarios(total_capital, monthly_income_goal, fetcher, user_weights, custom_allocs)
+        # Market data comes from the fetcher's daily disk cache, which never stores failed
+        # lookups, so regenerating after an outage retries them instead of reusing a partial result
+        scenarios = PortfolioCalculator().generate_scenarios(total_capital, monthly_income_goal, get_fetcher(), user_weights, custom_allocs)
         st.session_state['scenarios'] = scenarios
         st.session_state['investment_mode'] = investment_mode
         if investment_mode == "dca":
@@ -122,14 +147,14 @@ if st.button("生成投資組合", type="primary", disabled=(total_weight != 100
         st.success("計算完成！")
 
 def display_portfolio_result(portfolio_data, title, mode="lump_sum", dca_params=None):
-    portfolio, required_yield, usd_twd, history_series = portfolio_data
+    df, required_yield, usd_twd, history_series = portfolio_data
     
     st.header(title)
     st.info(f"當前匯率: 1 USD = {usd_twd:.2f} TWD")
     
     # Summary Metrics
-    total_cost = sum(item['cost_twd'] for item in portfolio)
-    total_income = sum(item['est_annual_income'] for item in portfolio)
+    total_cost = df['cost_twd'].sum() if not df.empty else 0
+    total_income = df['est_annual_income'].sum() if not df.empty else 0
     actual_yield = (total_income / total_cost) * 100 if total_cost > 0 else 0
     
     if mode == "lump_sum":
@@ -144,8 +169,7 @@ def display_portfolio_result(portfolio_data, title, mode="lump_sum", dca_params=
         years = dca_params['years']
         
         # Calculate Projection
-        calculator = PortfolioCalculator()
-        proj_df = calculator.calculate_dca_projection(monthly, years, actual_yield)
+        proj_df = cached_dca_projection(monthly, years, float(actual_yield))
         
         if not proj_df.empty:
             final_fv = proj_df.iloc[-1]['Asset Value']
@@ -161,12 +185,16 @@ def display_portfolio_result(portfolio_data, title, mode="lump_sum", dca_params=
     
     # Portfolio Table
     st.subheader("建議配置 (基於當前資金)")
-    df = pd.DataFrame(portfolio)
     
     if not df.empty:
+        # Select/reorder only the displayed columns so hidden ones aren't serialized;
+        # Arrow-backed dtypes let Streamlit ship the table without a pandas -> Arrow conversion
+        table_columns = ["symbol", "name", "type", "price", "quantity", "cost_twd", "yield_rate", "est_annual_income", "dividend_date", "fill_dividend_2y", "avg_fill_days", "pros", "cons"]
+        table_df = df[table_columns].convert_dtypes(dtype_backend='pyarrow')
+        
         # Format columns
         st.dataframe(
-            df,
+            table_df,
             column_config={
                 "symbol": "代碼",
                 "name": "名稱",
@@ -182,9 +210,10 @@ def display_portfolio_result(portfolio_data, title, mode="lump_sum", dca_params=
                 "fill_dividend_2y": "近2年填息(次)",
                 "avg_fill_days": "平均填息天數"
             },
-            column_order=["symbol", "name", "type", "price", "quantity", "cost_twd", "yield_rate", "est_annual_income", "dividend_date", "fill_dividend_2y", "avg_fill_days", "pros", "cons"],
             hide_index=True,
-            use_container_width=True
+            use_container_width=True,
+            # Fixed height keeps the grid virtualized (scrolls instead of growing) for long custom lists
+            height=min(35 * len(table_df) + 38, 400)
         )
         
         # Charts
@@ -192,25 +221,26 @@ def display_portfolio_result(portfolio_data, title, mode="lump_sum", dca_params=
         
         with col_chart1:
             st.subheader("資產配置 (圓餅圖)")
-            import plotly.express as px
-            fig = px.pie(df, values='cost_twd', names='name', title='投資組合配置')
-            st.plotly_chart(fig, use_container_width=True)
+            pie_df = df[['name', 'cost_twd']]
+            pie = alt.Chart(pie_df, title='投資組合配置').mark_arc(innerRadius=50).encode(
+                theta=alt.Theta('cost_twd:Q'),
+                color=alt.Color('name:N', title='名稱'),
+                tooltip=['name', alt.Tooltip('cost_twd:Q', title='預估成本 (TWD)', format=',.0f')]
+            )
+            st.altair_chart(pie, use_container_width=True)
             
         with col_chart2:
             st.subheader("過去6個月資產走勢 (回測)")
             if not history_series.empty:
-                st.line_chart(history_series)
+                st.line_chart(downsample_history(history_series))
             else:
                 st.write("無足夠歷史數據可顯示走勢圖")
     else:
         st.warning("此配置下無合適的投資標的。")
 
 # Main content
-if 'scenarios' in st.session_state:
-    scenarios = st.session_state['scenarios']
-    mode = st.session_state.get('investment_mode', 'lump_sum')
-    dca_params = st.session_state.get('dca_params', None)
-    
+@st.fragment
+def render_tabs(scenarios, mode, dca_params):
     tab1, tab2, tab3 = st.tabs(["自訂組合 (Custom)", "保守型 (Conservative)", "積極型 (Aggressive)"])
     
     with tab1:
@@ -220,5 +250,12 @@ if 'scenarios' in st.session_state:
     with tab3:
         display_portfolio_result(scenarios['Aggressive'], "積極型方案 (高股票)", mode, dca_params)
 
+if 'scenarios' in st.session_state:
+    scenarios = st.session_state['scenarios']
+    mode = st.session_state.get('investment_mode', 'lump_sum')
+    dca_params = st.session_state.get('dca_params', None)
+    
+    render_tabs(scenarios, mode, dca_params)
+
 else:
     st.info("請在左側輸入您的資金規劃與比重，並點擊「生成投資組合」")
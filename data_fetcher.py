@@ -1,23 +1,214 @@
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
 import re
 import logging
+from html import unescape
+import functools
+import inspect
+import threading
+from contextlib import contextmanager
+import diskcache
 import yfinance as yf
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+CACHE_EXPIRE_SECONDS = 2 * 24 * 3600
+
+def _is_missing(value):
+    if value is None:
+        return True
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return value.empty
+    if isinstance(value, dict):
+        return all(_is_missing(v) for v in value.values())
+    return False
+
+def _disk_cached(method):
+    """
+    Caches a DataFetcher method on disk, keyed by (method, arguments, today's date).
+    If a fetch comes back empty (network failure), the last good value is returned instead.
+    For dict results (bulk fetches) where only some entries are empty, those entries are
+    filled from the last good value and today's key is left unset, so the next call retries.
+    Wrapped methods must therefore report failure as None/empty rather than a default value;
+    defaults belong in the uncached caller.
+    """
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        arg_values = list(bound.arguments.values())[1:]
+        base_key = ":".join([method.__name__] + [str(v) for v in arg_values])
+        key = f"{base_key}:{date.today().isoformat()}"
+
+        value = self.cache.get(key)
+        if value is not None:
+            return value
+
+        value = method(self, *args, **kwargs)
+        if _is_missing(value):
+            stale = self.cache.get(f"{base_key}:latest")
+            if stale is not None:
+                logging.warning(f"Using stale cached value for {base_key}")
+                return stale
+            return value
+
+        if isinstance(value, dict) and any(_is_missing(v) for v in value.values()):
+            stale = self.cache.get(f"{base_key}:latest") or {}
+            value = {k: stale.get(k, v) if _is_missing(v) else v for k, v in value.items()}
+            logging.warning(f"Partial result for {base_key}; not caching it for today")
+            self.cache.set(f"{base_key}:latest", value)
+            return value
+
+        self.cache.set(key, value, expire=CACHE_EXPIRE_SECONDS)
+        self.cache.set(f"{base_key}:latest", value)
+        return value
+    return wrapper
+
+def _page_scoped(method):
+    """
+    Runs a scraping DataFetcher method inside _page_run, so pages fetched by a single
+    call are released afterwards (within a bulk run they are kept until the run ends).
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._page_run():
+            return method(self, *args, **kwargs)
+    return wrapper
+
 class DataFetcher:
-    def __init__(self):
+    # Fast paths for the Yahoo TW quote page; BeautifulSoup is only used when these miss
+    _PRICE_RE = re.compile(r'class="[^"]*Fz\(32px\)[^"]*"[^>]*>([\d,\.]+)<')
+    _TITLE_TAG_RE = re.compile(r'<title[^>]*>([^<]+)</title>')
+    # Title format: "復華富時不動產 (00712) - 個股走勢 - Yahoo奇摩股市"
+    # Name first, optional space, then (symbol) which may contain letters (e.g. 00981A) and a .TW suffix
+    _NAME_RE = re.compile(r'^(.+?)\s*\(([0-9A-Z]+)(\.[A-Z]+)?\)')
+    _DATE_RE = re.compile(r'\d{4}/\d{2}/\d{2}')
+
+    def __init__(self, max_workers=16, cache_dir=".cache/datafetcher"):
         self.headers = {
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         }
+        self.max_workers = max_workers
+
+        # One keep-alive session for every scrape: reuses TCP/TLS connections to Yahoo
+        # and is pooled wide enough for the concurrent bulk fetches
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        # Prices/dividends change at most daily, so results are shared across reruns
+        self.cache = diskcache.Cache(cache_dir)
+
+        # Yahoo TW pages (raw and parsed), so price and name lookups share one request.
+        # Only kept for the duration of one run (see _page_run); results live in self.cache
+        self._page_cache = {}
+        self._soup_cache = {}
+        self._page_run_depth = 0
+        self._page_run_lock = threading.Lock()
+
+    def _map_symbols(self, func, symbols):
+        """
+        Runs func(symbol) for each unique symbol concurrently.
+        Returns: dict {symbol: result}
+        """
+        symbols = list(dict.fromkeys(symbols))
+        if not symbols:
+            return {}
+        with self._page_run(), ThreadPoolExecutor(max_workers=min(self.max_workers, len(symbols))) as executor:
+            return dict(zip(symbols, executor.map(func, symbols)))
+
+    @contextmanager
+    def _page_run(self):
+        """
+        Scopes the page caches to one batch of lookups, so the long-lived fetcher
+        doesn't hold every scraped page (and its parse tree) in memory.
+        Runs may nest or overlap; the caches are cleared when the last one ends.
+        """
+        with self._page_run_lock:
+            self._page_run_depth += 1
+        try:
+            yield
+        finally:
+            with self._page_run_lock:
+                self._page_run_depth -= 1
+                if self._page_run_depth == 0:
+                    self._page_cache.clear()
+                    self._soup_cache.clear()
+
+    def _search_page(self, url, pattern):
+        """
+        Streams a page only until pattern matches, then drops the connection.
+        The text read so far is kept for later lookups on the same page.
+        Raises on HTTP errors.
+        Returns: re.Match or None
+        """
+        text, complete = self._page_cache.get(url, ("", False))
+        match = pattern.search(text)
+        if match or complete:
+            return match
+
+        text = ""
+        with self.session.get(url, stream=True) as response:
+            response.raise_for_status()
+            response.encoding = response.encoding or 'utf-8'
+            for chunk in response.iter_content(chunk_size=8192, decode_unicode=True):
+                # Re-scan a small overlap so matches spanning two chunks are found
+                start = max(0, len(text) - 1024)
+                text += chunk
+                match = pattern.search(text, start)
+                if match:
+                    self._page_cache[url] = (text, False)
+                    return match
+
+        self._page_cache[url] = (text, True)
+        return None
+
+    def _get_page(self, url):
+        """
+        Fetches a whole page, reusing the response text for the rest of the current run.
+        Raises on HTTP errors.
+        Returns: str
+        """
+        text, complete = self._page_cache.get(url, ("", False))
+        if not complete:
+            response = self.session.get(url)
+            response.raise_for_status()
+            text = response.text
+            self._page_cache[url] = (text, True)
+        return text
+
+    def _get_soup(self, url):
+        """
+        Parses a page fetched via _get_page, reusing the parsed result.
+        Raises on HTTP errors.
+        Returns: BeautifulSoup
+        """
+        soup = self._soup_cache.get(url)
+        if soup is None:
+            soup = BeautifulSoup(self._get_page(url), 'lxml')
+            self._soup_cache[url] = soup
+        return soup
 
     def get_exchange_rate(self, currency_pair="USDTWD=X"):
         """
         Fetches the current exchange rate. Default is USD to TWD.
+        Cached on disk per day like the other market data (refreshed on the first call each day),
+        falling back to the last good rate, then to a fixed default, when the fetch fails.
         """
+        rate = self._fetch_exchange_rate(currency_pair)
+        return rate if rate else 32.5 # Fallback default
+
+    @_disk_cached
+    def _fetch_exchange_rate(self, currency_pair):
         try:
             ticker = yf.Ticker(currency_pair)
             # Try to get fast info first
@@ -29,11 +220,12 @@ class DataFetcher:
             hist = ticker.history(period="1d")
             if not hist.empty:
                 return hist['Close'].iloc[-1]
-            return 32.5 # Fallback default
+            return None
         except Exception as e:
             logging.error(f"Error fetching exchange rate: {e}")
-            return 32.5
+            return None
 
+    @_disk_cached
     def get_historical_data(self, symbol, period="2y"):
         """
         Fetches historical price data.
@@ -46,6 +238,31 @@ class DataFetcher:
             logging.error(f"Error fetching historical data for {symbol}: {e}")
             return pd.DataFrame()
 
+    @_disk_cached
+    def get_historical_data_bulk(self, symbols, period="2y"):
+        """
+        Fetches historical price data for multiple symbols in one batched download.
+        Returns: dict {symbol: DataFrame}
+        """
+        symbols = list(dict.fromkeys(symbols))
+        if not symbols:
+            return {}
+        try:
+            # ignore_tz=False keeps the index tz-aware, like Ticker.history
+            data = yf.download(symbols, period=period, group_by='ticker', threads=True, progress=False, ignore_tz=False)
+        except Exception as e:
+            logging.error(f"Error fetching historical data for {symbols}: {e}")
+            return {symbol: pd.DataFrame() for symbol in symbols}
+
+        histories = {}
+        downloaded = set(data.columns.get_level_values(0)) if not data.empty else set()
+        for symbol in symbols:
+            # yfinance upper-cases tickers in the result columns
+            key = symbol.upper()
+            histories[symbol] = data[key].dropna(how='all') if key in downloaded else pd.DataFrame()
+        return histories
+
+    @_disk_cached
     def get_dividend_history(self, symbol):
         """
         Fetches dividend history.
@@ -62,12 +279,47 @@ class DataFetcher:
         Fetches dividend information for a given symbol.
         Returns: dict {'date': str, 'yield': float}
         """
+        return self._fetch_dividend_info(symbol) or {'date': 'N/A', 'yield': 0.0}
+
+    @_disk_cached
+    @_page_scoped
+    def _fetch_dividend_info(self, symbol):
+        """
+        Returns: dict {'date': str, 'yield': float}, or None if no source answered
+        """
         result = {'date': 'N/A', 'yield': 0.0}
         
-        # Try yfinance first
-        try:
-            ticker = yf.Ticker(symbol)
-            info = ticker.info
+        # Try trailing dividends over the current price first. Both lookups are disk-cached and
+        # shared with the rest of the run, which avoids the slow multi-field ticker.info scrape
+        history = self.get_dividend_history(symbol)
+        current_price = self.get_stock_price(symbol)
+        logging.info(f"[{symbol}] Dividend History Length: {len(history)}, Price: {current_price}")
+        
+        if not history.empty and current_price and current_price > 0:
+            # Yield from dividends paid in the last 365 days
+            # (index is sorted, so .loc slices by binary search instead of a full mask)
+            one_year_ago = pd.Timestamp.now(tz=history.index.tz) - pd.Timedelta(days=365)
+            total_div = history.loc[one_year_ago:].sum()
+            logging.info(f"[{symbol}] Total Div (Last Year): {total_div}")
+            result['yield'] = total_div / current_price
+            
+            # Most recent Ex-Dividend Date
+            result['date'] = history.index[-1].strftime('%Y/%m/%d')
+        else:
+            # yfinance hides network errors, so an empty history may be a failure rather than
+            # "no dividends"; only trust the default once ticker.info has actually answered
+            logging.info(f"[{symbol}] No dividend history or price, falling back to info")
+            try:
+                info = yf.Ticker(symbol).info or {}
+            except Exception as e:
+                logging.warning(f"yfinance dividend fetch failed for {symbol}: {e}")
+                info = {}
+            
+            answered_keys = ('dividendYield', 'trailingAnnualDividendRate', 'exDividendDate',
+                             'currentPrice', 'regularMarketPreviousClose')
+            if not any(info.get(k) is not None for k in answered_keys):
+                logging.warning(f"No dividend source answered for {symbol}")
+                return None
             
             # Get Yield
             div_yield = info.get('dividendYield')
@@ -84,63 +336,37 @@ class DataFetcher:
                 
                 if rate and price:
                     result['yield'] = rate / price
-                else:
-                    # Fallback: Calculate from dividend history (last 365 days)
-                    try:
-                        history = ticker.dividends
-                        logging.info(f"[{symbol}] Dividend History Length: {len(history)}")
-                        if not history.empty:
-                            # Handle timezone
-                            tz = history.index.tz
-                            one_year_ago = pd.Timestamp.now(tz=tz) - timedelta(days=365)
-                            last_year_divs = history[history.index >= one_year_ago]
-                            total_div = last_year_divs.sum()
-                            logging.info(f"[{symbol}] Total Div (Last Year): {total_div}")
-                            
-                            # Get current price
-                            current_price = info.get('currentPrice') or info.get('regularMarketPreviousClose') or ticker.fast_info.last_price
-                            logging.info(f"[{symbol}] Current Price for Fallback: {current_price}")
-                            
-                            if current_price and current_price > 0:
-                                result['yield'] = total_div / current_price
-                                logging.info(f"[{symbol}] Calculated yield from history: {result['yield']:.4f}")
-                    except Exception as e:
-                        logging.warning(f"[{symbol}] Fallback yield calculation failed: {e}")
             
             # Get Date (Ex-Dividend Date)
             ex_div_date = info.get('exDividendDate')
             if ex_div_date:
-                from datetime import datetime
                 result['date'] = datetime.fromtimestamp(ex_div_date).strftime('%Y/%m/%d')
-                
-        except Exception as e:
-            logging.warning(f"yfinance dividend fetch failed for {symbol}: {e}")
 
         # Fallback to scraping for Date if yfinance failed or returned nothing
         if result['date'] == 'N/A' and (symbol.endswith('.TW') or symbol.endswith('.TWO')):
             url = f"https://tw.stock.yahoo.com/quote/{symbol}/dividend"
             try:
-                response = requests.get(url, headers=self.headers)
-                if response.status_code == 200:
-                    soup = BeautifulSoup(response.text, 'html.parser')
-                    header_cell = soup.find('div', string="現金股利發放日")
-                    if header_cell:
-                        header_row = header_cell.find_parent('div', class_='table-header-wrapper')
-                        if header_row:
-                            parent = header_row.parent
-                            if parent:
-                                siblings = parent.find_next_siblings()
-                                for sib in siblings:
-                                    text = sib.get_text(strip=True)
-                                    date_match = re.search(r'\d{4}/\d{2}/\d{2}', text)
-                                    if date_match:
-                                        result['date'] = date_match.group(0)
-                                        break
+                soup = self._get_soup(url)
+                header_cell = soup.find('div', string="現金股利發放日")
+                if header_cell:
+                    header_row = header_cell.find_parent('div', class_='table-header-wrapper')
+                    if header_row:
+                        parent = header_row.parent
+                        if parent:
+                            siblings = parent.find_next_siblings()
+                            for sib in siblings:
+                                text = sib.get_text(strip=True)
+                                date_match = self._DATE_RE.search(text)
+                                if date_match:
+                                    result['date'] = date_match.group(0)
+                                    break
             except Exception as e:
                 logging.error(f"Scraping dividend info failed for {symbol}: {e}")
                 
         return result
 
+    @_disk_cached
+    @_page_scoped
     def get_stock_price(self, symbol):
         """
         Fetches the current stock price for a given symbol (TW or US).
@@ -158,20 +384,20 @@ class DataFetcher:
         url = f"https://tw.stock.yahoo.com/quote/{symbol}"
         logging.info(f"Fetching price for {symbol} from {url}")
         try:
-            response = requests.get(url, headers=self.headers)
-            if response.status_code != 200:
-                logging.error(f"Failed to fetch {url}: Status {response.status_code}")
-                return None
-                
-            soup = BeautifulSoup(response.text, 'html.parser')
+            # Strategy 1: Regex for the large price text (Fz(32px)), streaming only as far as needed
+            match = self._search_page(url, self._PRICE_RE)
+            if match:
+                return float(match.group(1).replace(',', ''))
+
+            soup = self._get_soup(url)
             
-            # Strategy 1: Look for the large price text (Fz(32px))
+            # Strategy 2: Look for the large price text (Fz(32px))
             price_element = soup.find('span', {'class': lambda x: x and 'Fz(32px)' in x})
             if price_element:
                 price_text = price_element.text.replace(',', '')
                 return float(price_text)
                 
-            # Strategy 2: Look for meta tags
+            # Strategy 3: Look for meta tags
             meta_price = soup.find('meta', {'itemprop': 'price'})
             if meta_price:
                 return float(meta_price['content'])
@@ -185,6 +411,8 @@ class DataFetcher:
 
 
 
+    @_disk_cached
+    @_page_scoped
     def get_stock_name(self, symbol):
         """
         Fetches the stock name for a given symbol.
@@ -195,27 +423,22 @@ class DataFetcher:
         if symbol.endswith('.TW') or symbol.endswith('.TWO'):
             url = f"https://tw.stock.yahoo.com/quote/{symbol}"
             try:
-                response = requests.get(url, headers=self.headers)
-                if response.status_code == 200:
-                    soup = BeautifulSoup(response.text, 'html.parser')
-                    
-                    # Method 1: Parse <title> tag
-                    # Format: "復華富時不動產 (00712) - 個股走勢 - Yahoo奇摩股市"
-                    title_text = soup.title.string if soup.title else ""
-                    logging.info(f"[{symbol}] Scraped Title: {title_text}")
+                # Method 1: Parse <title> tag
+                # Format: "復華富時不動產 (00712) - 個股走勢 - Yahoo奇摩股市"
+                title_match = self._search_page(url, self._TITLE_TAG_RE)
+                title_text = unescape(title_match.group(1)).strip() if title_match else ""
+                logging.info(f"[{symbol}] Scraped Title: {title_text}")
+                
+                match = self._NAME_RE.search(title_text)
+                if match:
+                    name = match.group(1).strip()
+                    logging.info(f"[{symbol}] Extracted Name: {name}")
+                    return name
                     
-                    # Regex: Start with name, optional space, then (symbol) which might include .TW
-                    # Updated to allow letters in symbol (e.g. 00981A)
-                    match = re.search(r'^(.+?)\s*\(([0-9A-Z]+)(\.[A-Z]+)?\)', title_text)
-                    if match:
-                        name = match.group(1).strip()
-                        logging.info(f"[{symbol}] Extracted Name: {name}")
-                        return name
-                        
-                    # Method 2: Try h1 with specific class if title fails
-                    h1 = soup.find('h1')
-                    if h1 and "Yahoo" not in h1.text:
-                        return h1.text.strip()
+                # Method 2: Try h1 with specific class if title fails
+                h1 = self._get_soup(url).find('h1')
+                if h1 and "Yahoo" not in h1.text:
+                    return h1.text.strip()
             except Exception as e:
                 logging.error(f"Scraping name failed for {symbol}: {e}")
 
@@ -231,9 +454,70 @@ class DataFetcher:
             
         return None
 
+    def get_prices_bulk(self, symbols):
+        """
+        Fetches current prices for multiple symbols concurrently.
+        Returns: dict {symbol: float or None}
+        """
+        return self._map_symbols(self.get_stock_price, symbols)
+
+    def get_dividend_info_bulk(self, symbols):
+        """
+        Fetches dividend information for multiple symbols concurrently.
+        Returns: dict {symbol: {'date': str, 'yield': float}}
+        """
+        return self._map_symbols(self.get_dividend_info, symbols)
+
+    def _fetch_symbol(self, symbol, with_name=False):
+        """
+        Runs every per-symbol lookup the portfolio calculator needs for one symbol.
+        Returns: dict {'price', 'div_info', 'dividends', 'name'}
+        """
+        return {
+            'price': self.get_stock_price(symbol),
+            'div_info': self.get_dividend_info(symbol),
+            'dividends': self.get_dividend_history(symbol),
+            'name': self.get_stock_name(symbol) if with_name else None
+        }
+
+    def bulk_fetch(self, symbols, periods=("2y",), name_symbols=()):
+        """
+        Fetches everything the portfolio calculator needs for each symbol in one thread pool:
+        one task per symbol for the per-symbol lookups, running alongside one batched
+        history download per period.
+        name_symbols: symbols whose display name should also be looked up
+        Returns: dict {symbol: {'price', 'div_info', 'dividends', 'name', 'history_<period>'...}}
+        """
+        symbols = list(dict.fromkeys(symbols))
+        if not symbols:
+            return {}
+        name_symbols = set(name_symbols)
+        
+        market_data = {}
+        with self._page_run(), ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            history_futures = {
+                executor.submit(self.get_historical_data_bulk, symbols, period): period
+                for period in periods
+            }
+            symbol_futures = {
+                executor.submit(self._fetch_symbol, symbol, symbol in name_symbols): symbol
+                for symbol in symbols
+            }
+            
+            for future in as_completed(symbol_futures):
+                market_data[symbol_futures[future]] = future.result()
+            for future in as_completed(history_futures):
+                period = history_futures[future]
+                histories = future.result()
+                for symbol in symbols:
+                    market_data[symbol][f'history_{period}'] = histories.get(symbol, pd.DataFrame())
+                    
+        return {symbol: market_data[symbol] for symbol in symbols}
+
 if __name__ == "__main__":
     fetcher = DataFetcher()
     print(f"2330.TW Price: {fetcher.get_stock_price('2330.TW')}")
     print(f"AAPL Price: {fetcher.get_stock_price('AAPL')}")
     print(f"2330.TW Dividend: {fetcher.get_dividend_info('2330.TW')}")
     print(f"00712.TW Name: {fetcher.get_stock_name('00712.TW')}")
+    print(f"Bulk Prices: {fetcher.get_prices_bulk(['2330.TW', 'AAPL', 'VOO'])}")
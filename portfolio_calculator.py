@@ -1,6 +1,27 @@
+import logging
 import pandas as pd
 import numpy as np
-from datetime import timedelta
+from numba import njit
+
+log = logging.getLogger(__name__)
+
+@njit(cache=True)
+def _fill_scan(high, ex_idx, pre_close):
+    """
+    For each ex-dividend index, scans forward for the first day High >= pre_close.
+    Returns: (filled_count, total_days_to_fill)
+    """
+    filled = 0
+    total_days = 0
+    for k in range(ex_idx.size):
+        start = ex_idx[k]
+        threshold = pre_close[k]
+        for j in range(start, high.size):
+            if high[j] >= threshold:
+                filled += 1
+                total_days += j - start
+                break
+    return filled, total_days
 
 class PortfolioCalculator:
     def __init__(self):
@@ -15,6 +36,12 @@ class PortfolioCalculator:
             {'symbol': 'BND', 'name': 'Vanguard Total Bond Market', 'type': 'Bond', 'market': 'US'},
         ]
         
+        # Candidates bucketed by type once, instead of re-filtering the pool per scenario
+        self.candidates_by_type = {'Stock': [], 'ETF': [], 'Bond': []}
+        for candidate in self.candidates:
+            candidate['is_us'] = candidate['market'] == 'US'
+            self.candidates_by_type[candidate['type']].append(candidate)
+        
         self.pros_cons_db = {
             '2330.TW': {'pros': '全球晶圓代工龍頭，技術領先', 'cons': '受地緣政治風險影響較大'},
             '0050.TW': {'pros': '追蹤台股前50大市值公司，跟隨大盤成長', 'cons': '受單一產業(半導體)權重影響大'},
@@ -28,63 +55,52 @@ class PortfolioCalculator:
     def get_pros_cons(self, symbol):
         return self.pros_cons_db.get(symbol, {'pros': 'N/A', 'cons': 'N/A'})
 
-    def analyze_fill_dividend(self, symbol, history, dividends):
+    def analyze_fill_dividend(self, symbol, history, dividends, cutoff_date=None):
         """
         Analyzes fill dividend status for the last 2 years.
+        cutoff_date: optional tz-aware start of the 2-year window, so batch callers compute it once
         Returns: {'filled_count': int, 'total_count': int, 'avg_days': float}
         """
         if history.empty or dividends.empty:
             return {'filled_count': 0, 'total_count': 0, 'avg_days': 0}
 
         # Filter dividends for last 2 years
-        cutoff_date = pd.Timestamp.now(tz=dividends.index.tz) - timedelta(days=730)
+        if cutoff_date is None:
+            cutoff_date = pd.Timestamp.now(tz='UTC') - pd.Timedelta(days=730)
+        if cutoff_date.tz != dividends.index.tz:
+            cutoff_date = cutoff_date.tz_convert(dividends.index.tz)
         recent_dividends = dividends[dividends.index >= cutoff_date]
         
         if recent_dividends.empty:
             return {'filled_count': 0, 'total_count': 0, 'avg_days': 0}
 
-        filled_count = 0
-        total_days = 0
+        # Put the dividend dates on the history's timezone so searchsorted compares like with like
+        ex_dates = recent_dividends.index
+        history_tz = history.index.tz
+        if ex_dates.tz is None:
+            if history_tz is not None:
+                ex_dates = ex_dates.tz_localize(history_tz)
+        elif history_tz is None:
+            ex_dates = ex_dates.tz_localize(None)
+        else:
+            ex_dates = ex_dates.tz_convert(history_tz)
         
-        for date, amount in recent_dividends.items():
-            # Find the ex-dividend date index in history
-            # yfinance dividend dates are usually ex-dates
-            try:
-                # Convert to timezone naive for comparison if needed, or ensure match
-                # history index is usually tz-aware if downloaded that way.
-                # Let's try to find the closest trading day at or after ex-date
-                ex_date_idx = history.index.searchsorted(date)
-                if ex_date_idx >= len(history):
-                    continue
-                    
-                ex_date_price = history.iloc[ex_date_idx]['Close']
-                # Pre-dividend price reference (approximate as Close + Dividend or Prev Close)
-                # Strictly speaking, fill dividend means price returns to pre-ex-dividend close.
-                # Pre-ex-dividend close = Open on ex-day? No, Close of prev day.
-                
-                if ex_date_idx > 0:
-                    pre_close = history.iloc[ex_date_idx - 1]['Close']
-                else:
-                    pre_close = ex_date_price + amount # Approximation
-
-                # Check if price recovered to pre_close
-                future_prices = history.iloc[ex_date_idx:]['High'] # Use High to check if it touched the price
-                
-                days_to_fill = 0
-                filled = False
-                
-                for i, price in enumerate(future_prices):
-                    if price >= pre_close:
-                        days_to_fill = i
-                        filled = True
-                        break
-                
-                if filled:
-                    filled_count += 1
-                    total_days += days_to_fill
-                    
-            except Exception as e:
-                continue
+        high = history['High'].to_numpy(dtype=float)
+        close = history['Close'].to_numpy(dtype=float)
+        
+        # Ex-dividend date -> index of the first trading day at or after it
+        # (yfinance dividend dates are usually ex-dates)
+        ex_idx = history.index.searchsorted(ex_dates)
+        in_range = ex_idx < len(history)
+        ex_idx = ex_idx[in_range]
+        amounts = recent_dividends.to_numpy(dtype=float)[in_range]
+        
+        # Fill dividend means price returns to the pre-ex-dividend close (Close of prev day);
+        # for an ex-date on the first day of history, approximate with Close + Dividend
+        pre_close = np.where(ex_idx > 0, close[np.maximum(ex_idx - 1, 0)], close[ex_idx] + amounts)
+        
+        # Scan forward (compiled, with early exit) for the first day High touches pre_close
+        filled_count, total_days = _fill_scan(high, ex_idx.astype(np.int64), pre_close)
 
         avg_days = total_days / filled_count if filled_count > 0 else 0
         return {
@@ -93,19 +109,89 @@ class PortfolioCalculator:
             'avg_days': avg_days
         }
 
-    def calculate_portfolio(self, total_capital, monthly_income_goal, fetcher, weights, custom_allocations=[]):
+    def _fetch_market_data(self, fetcher, custom_allocations):
+        """
+        Fetches everything any scenario needs for the custom symbols and the candidate pool,
+        so each (symbol, period) is requested only once per run.
+        Returns: dict {symbol: {'price', 'div_info', 'dividends', 'name', 'history_2y', 'history_6mo'}}
+        """
+        custom_symbols = [c['symbol'] for c in custom_allocations]
+        symbols = custom_symbols + [c['symbol'] for c in self.candidates]
+        # 2y history for fill-dividend analysis; the 6mo backtest window is a slice of it
+        market_data = fetcher.bulk_fetch(symbols, periods=("2y",), name_symbols=custom_symbols)
+        cutoff_6mo = pd.Timestamp.now(tz='UTC') - pd.Timedelta(days=183)
+        for data in market_data.values():
+            history = data['history_2y']
+            if not history.empty:
+                history = history.loc[history.index >= cutoff_6mo.tz_convert(history.index.tz)]
+            data['history_6mo'] = history
+        return market_data
+
+    def _build_symbol_metadata(self, market_data, custom_allocations, usd_twd):
+        """
+        Derives everything about a symbol that does not depend on weights (TWD price, yield,
+        fill-dividend stats, pros/cons), so the scenarios only differ in the capital arithmetic.
+        Returns: dict {symbol: {'name', 'price', 'price_twd', 'fx_mult', 'yield', 'dividend_date',
+                                'pros', 'cons', 'fill_dividend_2y', 'avg_fill_days', 'history_6mo'}}
+        """
+        # Custom symbols use a simple heuristic: .TW or .TWO is TW, else US
+        symbol_is_us = {c['symbol']: c['is_us'] for c in self.candidates}
+        for custom in custom_allocations:
+            symbol_is_us[custom['symbol']] = not custom['symbol'].endswith(('.TW', '.TWO'))
+        
+        # One 2-year window start for the whole batch
+        cutoff_2y = pd.Timestamp.now(tz='UTC') - pd.Timedelta(days=730)
+        
+        metadata = {}
+        for symbol, data in market_data.items():
+            price = data['price']
+            div_info = data['div_info']
+            fx_mult = usd_twd if symbol_is_us[symbol] else 1.0
+            fill_stats = self.analyze_fill_dividend(symbol, data['history_2y'], data['dividends'], cutoff_2y)
+            pros_cons = self.get_pros_cons(symbol)
+            metadata[symbol] = {
+                'name': data['name'],
+                'price': price,
+                'price_twd': price * fx_mult if price else 0.0,
+                'fx_mult': fx_mult,
+                'yield': div_info.get('yield') or 0.0,
+                'dividend_date': div_info.get('date', 'N/A'),
+                'pros': pros_cons['pros'],
+                'cons': pros_cons['cons'],
+                'fill_dividend_2y': f"{fill_stats['filled_count']}/{fill_stats['total_count']}",
+                'avg_fill_days': f"{fill_stats['avg_days']:.1f} 天",
+                'history_6mo': data['history_6mo'],
+            }
+        return metadata
+
+    def calculate_portfolio(self, total_capital, monthly_income_goal, fetcher, weights, custom_allocations=[], symbol_metadata=None, usd_twd=None):
         """
         Calculates a proposed portfolio allocation based on weights.
         weights: dict {'Stock': float, 'ETF': float, 'Bond': float} (sum to 1.0)
         custom_allocations: list of dict {'symbol': str, 'weight': float} (weight is 0.0-1.0)
+        symbol_metadata: optional result of _build_symbol_metadata covering all symbols involved
+        usd_twd: optional USD/TWD rate already fetched for this run (required with symbol_metadata)
+        Returns: (portfolio DataFrame with one row per holding, required_yield, usd_twd, total_history)
         """
         annual_income_goal = monthly_income_goal * 12
         required_yield = (annual_income_goal / total_capital) * 100 if total_capital > 0 else 0
         
-        portfolio = []
+        # Get Exchange Rate (unless the caller already has it for this run)
+        if usd_twd is None:
+            usd_twd = fetcher.get_exchange_rate()
         
-        # Get Exchange Rate
-        usd_twd = fetcher.get_exchange_rate()
+        # Fetch market data for every symbol we may allocate to in one pass
+        if symbol_metadata is None:
+            market_data = self._fetch_market_data(fetcher, custom_allocations)
+            symbol_metadata = self._build_symbol_metadata(market_data, custom_allocations, usd_twd)
+        
+        # Per-asset inputs are collected first; the money arithmetic runs once over arrays below
+        assets = []
+        alloc_capitals = []
+        
+        def add_asset(symbol, name, asset_type, alloc_capital):
+            assets.append((symbol, name, asset_type, symbol_metadata[symbol]))
+            alloc_capitals.append(alloc_capital)
         
         # 1. Process Custom Allocations first
         remaining_capital = total_capital
@@ -114,70 +200,23 @@ class PortfolioCalculator:
             symbol = custom['symbol']
             weight = custom['weight']
             
+            meta = symbol_metadata[symbol]
+            
             # Validate symbol exists/is fetchable (simple check)
-            price = fetcher.get_stock_price(symbol)
-            if not price:
-                logging.warning(f"Could not fetch price for custom symbol: {symbol}")
+            if not meta['price']:
+                log.warning(f"Could not fetch price for custom symbol: {symbol}")
                 continue
                 
             alloc_capital = total_capital * weight
             remaining_capital -= alloc_capital
             
-            div_info = fetcher.get_dividend_info(symbol)
-            history = fetcher.get_historical_data(symbol, period="2y")
-            dividends = fetcher.get_dividend_history(symbol)
-            fill_stats = self.analyze_fill_dividend(symbol, history, dividends)
-            pros_cons = self.get_pros_cons(symbol)
-            
-            # Fetch Name
-            stock_name = fetcher.get_stock_name(symbol)
+            stock_name = meta['name']
             display_name = f"{stock_name} ({symbol})" if stock_name else f"{symbol} (自訂)"
             
-            price_twd = price
-            # Guess market based on symbol format or previous knowledge
-            # Simple heuristic: .TW or .TWO is TW, else US
-            is_us = not (symbol.endswith('.TW') or symbol.endswith('.TWO'))
-            if is_us:
-                price_twd = price * usd_twd
-            
-            quantity = int(alloc_capital / price_twd) if price_twd > 0 else 0
-            cost = quantity * price_twd
-            
-            yield_rate = div_info.get('yield', 0.0)
-            if yield_rate is None: yield_rate = 0.0
-            
-            est_annual_income = cost * yield_rate
-            
-            portfolio.append({
-                'symbol': symbol,
-                'name': display_name,
-                'type': 'Custom',
-                'price': price,
-                'price_twd': price_twd,
-                'quantity': quantity,
-                'cost_twd': cost,
-                'est_annual_income': est_annual_income,
-                'yield_rate': yield_rate * 100,
-                'dividend_date': div_info.get('date', 'N/A'),
-                'pros': pros_cons['pros'],
-                'cons': pros_cons['cons'],
-                'fill_dividend_2y': f"{fill_stats['filled_count']}/{fill_stats['total_count']}",
-                'avg_fill_days': f"{fill_stats['avg_days']:.1f} 天"
-            })
+            add_asset(symbol, display_name, 'Custom', alloc_capital)
 
         # 2. Allocate Remaining Capital to Categories
         if remaining_capital > 0:
-            # Filter candidates by type
-            stocks = [c for c in self.candidates if c['type'] == 'Stock']
-            etfs = [c for c in self.candidates if c['type'] == 'ETF']
-            bonds = [c for c in self.candidates if c['type'] == 'Bond']
-            
-            # Allocate capital to categories based on weights (relative to remaining)
-            # Weights sum to 1.0 (100%). We apply these % to the *Remaining Capital*.
-            capital_stock = remaining_capital * weights.get('Stock', 0)
-            capital_etf = remaining_capital * weights.get('ETF', 0)
-            capital_bond = remaining_capital * weights.get('Bond', 0)
-            
             # For backtesting (only for auto-allocated parts + custom? 
             # Ideally backtest everything. Let's rebuild history for ALL items at the end)
             
@@ -189,81 +228,63 @@ class PortfolioCalculator:
                 
                 for candidate in candidates:
                     symbol = candidate['symbol']
-                    price = fetcher.get_stock_price(symbol)
-                    div_info = fetcher.get_dividend_info(symbol)
-                    
-                    history = fetcher.get_historical_data(symbol, period="2y")
-                    dividends = fetcher.get_dividend_history(symbol)
-                    fill_stats = self.analyze_fill_dividend(symbol, history, dividends)
-                    pros_cons = self.get_pros_cons(symbol)
-                    
-                    if price:
-                        price_twd = price
-                        if candidate['market'] == 'US':
-                            price_twd = price * usd_twd
-                        
-                        quantity = int(allocation_per_asset / price_twd)
-                        cost = quantity * price_twd
-                        
-                        yield_rate = div_info.get('yield', 0.0)
-                        if yield_rate is None: yield_rate = 0.0
-                        
-                        est_annual_income = cost * yield_rate
-                        
-                        portfolio.append({
-                            'symbol': symbol,
-                            'name': candidate['name'],
-                            'type': candidate['type'],
-                            'price': price,
-                            'price_twd': price_twd,
-                            'quantity': quantity,
-                            'cost_twd': cost,
-                            'est_annual_income': est_annual_income,
-                            'yield_rate': yield_rate * 100,
-                            'dividend_date': div_info.get('date', 'N/A'),
-                            'pros': pros_cons['pros'],
-                            'cons': pros_cons['cons'],
-                            'fill_dividend_2y': f"{fill_stats['filled_count']}/{fill_stats['total_count']}",
-                            'avg_fill_days': f"{fill_stats['avg_days']:.1f} 天"
-                        })
+                    if symbol_metadata[symbol]['price']:
+                        add_asset(symbol, candidate['name'], candidate['type'], allocation_per_asset)
+
+            # Allocate capital to categories based on weights (relative to remaining)
+            # Weights sum to 1.0 (100%). We apply these % to the *Remaining Capital*.
+            for category, candidates in self.candidates_by_type.items():
+                process_category(candidates, remaining_capital * weights.get(category, 0))
 
-            process_category(stocks, capital_stock)
-            process_category(etfs, capital_etf)
-            process_category(bonds, capital_bond)
+        symbols, names, asset_types, metas = zip(*assets) if assets else ((),) * 4
+        
+        # Whole shares per asset (0 when there is no usable price), cost and income in one pass
+        prices_twd = np.array([meta['price_twd'] for meta in metas], dtype=np.float64)
+        yields = np.array([meta['yield'] for meta in metas], dtype=np.float64)
+        alloc_capitals = np.array(alloc_capitals, dtype=np.float64)
+        # Truncate the rounded quotient like int(a / b); float floor_divide can land one share lower
+        quantities = np.divide(alloc_capitals, prices_twd, out=np.zeros_like(alloc_capitals),
+                               where=prices_twd > 0).astype(np.int64)
+        costs = quantities * prices_twd
+        incomes = costs * yields
+        
+        # Build the result column-wise in one DataFrame constructor call
+        portfolio = pd.DataFrame({
+            'symbol': symbols,
+            'name': names,
+            'type': asset_types,
+            'price': np.array([meta['price'] for meta in metas], dtype=np.float64),
+            'price_twd': prices_twd,
+            'quantity': quantities,
+            'cost_twd': costs,
+            'est_annual_income': incomes,
+            'yield_rate': yields * 100,
+            'dividend_date': [meta['dividend_date'] for meta in metas],
+            'pros': [meta['pros'] for meta in metas],
+            'cons': [meta['cons'] for meta in metas],
+            'fill_dividend_2y': [meta['fill_dividend_2y'] for meta in metas],
+            'avg_fill_days': [meta['avg_fill_days'] for meta in metas],
+        })
 
         # 3. Generate Total History (Backtest) for the entire portfolio
-        portfolio_history = pd.DataFrame()
-        for item in portfolio:
-            symbol = item['symbol']
-            quantity = item['quantity']
+        # Collect one scaled series per symbol and align them all in a single concat
+        history_series = {}
+        for symbol, meta, quantity in zip(symbols, metas, quantities.tolist()):
+            history = meta['history_6mo']
             
-            # We need to re-fetch history if not cached, but for now let's just fetch again or optimize later
-            # To save time, we could have stored history in the item dict, but it's heavy.
-            # Let's just fetch 6mo history here.
-            history = fetcher.get_historical_data(symbol, period="6mo")
-            
-            if not history.empty:
-                recent_history = history['Close'].copy()
-                
-                # Determine market for currency conversion
-                is_us = not (symbol.endswith('.TW') or symbol.endswith('.TWO'))
-                if is_us:
-                    recent_history = recent_history * usd_twd * quantity
-                else:
-                    recent_history = recent_history * quantity
-                    
-                if portfolio_history.empty:
-                    portfolio_history = pd.DataFrame(recent_history).rename(columns={'Close': symbol})
-                else:
-                    # Check if symbol already exists in columns to avoid overlap error
-                    if symbol not in portfolio_history.columns:
-                        portfolio_history = portfolio_history.join(pd.DataFrame(recent_history).rename(columns={'Close': symbol}), how='outer')
+            # A symbol can appear twice (custom + candidate); keep the first, as before
+            if not history.empty and symbol not in history_series:
+                # Currency conversion and position size folded into one scalar,
+                # applied straight to the close array without an intermediate copy
+                closes = history['Close'].to_numpy(copy=False)
+                history_series[symbol] = pd.Series(closes * (meta['fx_mult'] * quantity),
+                                                   index=history.index, name=symbol)
 
         # Calculate Total Portfolio Value History
         total_history = pd.Series()
-        if not portfolio_history.empty:
-            portfolio_history['Total Value'] = portfolio_history.sum(axis=1)
-            total_history = portfolio_history['Total Value'].ffill().bfill()
+        if history_series:
+            portfolio_history = pd.concat(history_series, axis=1)
+            total_history = portfolio_history.sum(axis=1).rename('Total Value').ffill().bfill()
                 
         return portfolio, required_yield, usd_twd, total_history
 
@@ -275,55 +296,51 @@ class PortfolioCalculator:
         - Reinvested dividends? Simplified: Total Return = Yield + Growth.
         - Let's assume a conservative Capital Growth rate of 3% + Yield.
         """
-        months = years * 12
         annual_growth_rate = 0.03 # 3% capital appreciation assumption
         total_annual_return = (portfolio_yield_percent / 100) + annual_growth_rate
         monthly_return = total_annual_return / 12
         
-        future_value = 0
-        total_cost = 0
-        
-        # FV = P * ((1+r)^n - 1)/r * (1+r)
-        if monthly_return > 0:
-            future_value = monthly_amount * (((1 + monthly_return) ** months - 1) / monthly_return) * (1 + monthly_return)
-        else:
-            future_value = monthly_amount * months
-            
-        total_cost = monthly_amount * months
-        
         # Generate chart data (Yearly)
-        data = []
-        current_fv = 0
-        current_cost = 0
-        for m in range(1, months + 1):
-            current_cost += monthly_amount
-            current_fv = (current_fv + monthly_amount) * (1 + monthly_return)
-            
-            if m % 12 == 0:
-                year = m // 12
-                data.append({
-                    'Year': year,
-                    'Total Cost': current_cost,
-                    'Asset Value': current_fv,
-                    'Passive Income (Yearly)': current_fv * (portfolio_yield_percent / 100)
-                })
+        # FV after n monthly deposits = P * ((1+r)^n - 1)/r * (1+r), evaluated at each year boundary
+        years_arr = np.arange(1, years + 1)
+        months_arr = years_arr * 12
+        if monthly_return != 0:
+            asset_values = monthly_amount * (((1 + monthly_return) ** months_arr - 1) / monthly_return) * (1 + monthly_return)
+        else:
+            asset_values = monthly_amount * months_arr.astype(float)
                 
-        return pd.DataFrame(data)
+        return pd.DataFrame({
+            'Year': years_arr,
+            'Total Cost': monthly_amount * months_arr,
+            'Asset Value': asset_values,
+            'Passive Income (Yearly)': asset_values * (portfolio_yield_percent / 100)
+        })
 
     def generate_scenarios(self, total_capital, monthly_income_goal, fetcher, user_weights, custom_allocations=[]):
         """
         Generates 3 scenarios: Custom, Conservative, Aggressive.
         """
-        # 1. Custom (Includes User's Custom Products)
-        custom_port = self.calculate_portfolio(total_capital, monthly_income_goal, fetcher, user_weights, custom_allocations)
+        # Fetch market data for the union of all scenarios' symbols once, then share it
+        market_data = self._fetch_market_data(fetcher, custom_allocations)
+        # The FX rate is the same for every scenario in a run
+        usd_twd = fetcher.get_exchange_rate()
+        # Weight-independent per-symbol data is derived once; scenarios only redo the arithmetic
+        symbol_metadata = self._build_symbol_metadata(market_data, custom_allocations, usd_twd)
         
-        # 2. Conservative (Stock 20%, ETF 40%, Bond 40%) - No custom products for standard scenarios
-        conservative_weights = {'Stock': 0.2, 'ETF': 0.4, 'Bond': 0.4}
-        conservative_port = self.calculate_portfolio(total_capital, monthly_income_goal, fetcher, conservative_weights, [])
+        scenario_configs = [
+            # 1. Custom (Includes User's Custom Products)
+            (user_weights, custom_allocations),
+            # 2. Conservative (Stock 20%, ETF 40%, Bond 40%) - No custom products for standard scenarios
+            ({'Stock': 0.2, 'ETF': 0.4, 'Bond': 0.4}, []),
+            # 3. Aggressive (Stock 60%, ETF 40%, Bond 0%) - No custom products for standard scenarios
+            ({'Stock': 0.6, 'ETF': 0.4, 'Bond': 0.0}, []),
+        ]
         
-        # 3. Aggressive (Stock 60%, ETF 40%, Bond 0%) - No custom products for standard scenarios
-        aggressive_weights = {'Stock': 0.6, 'ETF': 0.4, 'Bond': 0.0}
-        aggressive_port = self.calculate_portfolio(total_capital, monthly_income_goal, fetcher, aggressive_weights, [])
+        # Pure arithmetic over the shared metadata from here on, so no threads needed
+        custom_port, conservative_port, aggressive_port = [
+            self.calculate_portfolio(total_capital, monthly_income_goal, fetcher, weights, allocations, symbol_metadata, usd_twd)
+            for weights, allocations in scenario_configs
+        ]
         
         return {
             'Custom': custom_port,